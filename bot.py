@@ -1,26 +1,63 @@
 import os
+import tempfile
+import shutil
+import re
+import copy
+import queue
+import contextlib
+from types import MappingProxyType
+import time
+import random
 import logging
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+from telegram.constants import ChatAction
+from telegram.error import TelegramError
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     filters,
     ContextTypes,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    AIORateLimiter
 )
 import yt_dlp
 from dotenv import load_dotenv
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import uvloop
+except ImportError:  # Not available on Windows
+    uvloop = None
 
 # Load environment variables
 load_dotenv()
 
 # --- Configuration ---
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-DOWNLOAD_DIR = "downloads"
 MAX_FILE_SIZE = 50 * 1024 * 1024
 PORT = int(os.getenv('PORT', 10000))  # For Render compatibility
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Public base URL; polling is used when unset
+# Signed YouTube stream URLs expire after ~6h, so keep cached metadata well below that
+INFO_CACHE_TTL = int(os.getenv('INFO_CACHE_TTL', 60 * 60))
+FILE_ID_CACHE_TTL = int(os.getenv('FILE_ID_CACHE_TTL', 7 * 24 * 60 * 60))
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv('MAX_CONCURRENT_DOWNLOADS', 3))
+
+def _default_download_dir() -> str:
+    """Prefer RAM-backed /dev/shm when it can hold every in-flight file"""
+    # Files only live between download and upload, so tmpfs saves a disk
+    # write and read-back. Docker caps /dev/shm at 64 MB by default, hence
+    # the room check; uploads run outside the download limit, so allow 2x
+    try:
+        shm = os.statvfs('/dev/shm')
+        if shm.f_bavail * shm.f_frsize >= 2 * MAX_CONCURRENT_DOWNLOADS * MAX_FILE_SIZE:
+            return '/dev/shm/vibebot'
+    except (OSError, AttributeError):  # No /dev/shm, or no statvfs on Windows
+        pass
+    return os.path.join(tempfile.gettempdir(), 'vibebot')
+
+DOWNLOAD_DIR = os.getenv('DOWNLOAD_DIR') or _default_download_dir()
 
 # --- Setup ---
 logging.basicConfig(
@@ -29,281 +66,564 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-if not os.path.exists(DOWNLOAD_DIR):
-    os.makedirs(DOWNLOAD_DIR)
+os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
 # --- Your existing bot handlers and functions remain the same ---
+_WELCOME_TEMPLATE = (
+    "Hi {user_name}! 👋\n\n"
+    "I'm your YouTube Downloader Bot running on Render! 🚀\n\n"
+    "Just send me a YouTube link to download video or audio."
+)
+
+_HELP_TEXT = (
+    "How to use me:\n"
+    "1. Send a YouTube link\n"
+    "2. Choose video or audio\n"
+    "3. I'll download it for you!\n\n"
+    "Note: Some videos might not be available due to restrictions."
+)
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_name = update.effective_user.first_name
-    welcome_message = (
-        f"Hi {user_name}! 👋\n\n"
-        "I'm your YouTube Downloader Bot running on Render! 🚀\n\n"
-        "Just send me a YouTube link to download video or audio."
-    )
-    await update.message.reply_text(welcome_message)
+    await update.message.reply_text(_WELCOME_TEMPLATE.format(user_name=update.effective_user.first_name))
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    help_text = (
-        "How to use me:\n"
-        "1. Send a YouTube link\n"
-        "2. Choose video or audio\n"
-        "3. I'll download it for you!\n\n"
-        "Note: Some videos might not be available due to restrictions."
-    )
-    await update.message.reply_text(help_text)
+    await update.message.reply_text(_HELP_TEXT)
+
+_YOUTUBE_URL_RE = re.compile(r'(?:https?://)?(?:www\.|m\.|music\.)?(?:youtube\.com|youtu\.be)/\S+', re.IGNORECASE)
 
 def is_valid_youtube_url(url: str) -> bool:
-    youtube_domains = ['youtube.com', 'youtu.be', 'www.youtube.com', 'm.youtube.com']
-    return any(domain in url for domain in youtube_domains)
+    return _YOUTUBE_URL_RE.match(url) is not None
+
+# The lookahead rejects longer (typo'd or corrupted) IDs instead of
+# truncating them to a different video
+_VIDEO_ID_RE = re.compile(r'(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/|/v/)([0-9A-Za-z_-]{11})(?![0-9A-Za-z_-])')
+
+_BARE_VIDEO_ID_RE = re.compile(r'[0-9A-Za-z_-]{11}')
+
+def extract_video_id(url: str) -> str | None:
+    """Return the 11-character YouTube video ID contained in url, if any"""
+    match = _VIDEO_ID_RE.search(url)
+    return match.group(1) if match else None
+
+def video_from_id(video_id: str) -> dict:
+    return {'id': video_id, 'url': f'https://www.youtube.com/watch?v={video_id}'}
+
+def parse_youtube_url(url: str) -> dict | None:
+    """Reduce a YouTube link to its video ID and canonical watch URL"""
+    if not is_valid_youtube_url(url):
+        return None
+    video_id = extract_video_id(url)
+    if not video_id:
+        return None
+    return video_from_id(video_id)
+
+def download_markup(video_id: str) -> InlineKeyboardMarkup:
+    """Download keyboard whose buttons carry the video ID in their callback data"""
+    # "download_both:<11-char id>" stays well under Telegram's 64-byte limit
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🎬 Video", callback_data=f'download_video:{video_id}'),
+         InlineKeyboardButton("🎵 Audio", callback_data=f'download_audio:{video_id}')],
+        [InlineKeyboardButton("🎬+🎵 Both", callback_data=f'download_both:{video_id}')],
+    ])
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message_text = update.message.text.strip()
     
-    if not is_valid_youtube_url(message_text):
+    video = parse_youtube_url(message_text)
+    if not video:
         await update.message.reply_text("Please send a valid YouTube URL!")
         return
 
-    context.user_data['url'] = message_text
+    await update.message.reply_text('Choose download type:', reply_markup=download_markup(video['id']))
 
-    keyboard = [
-        [InlineKeyboardButton("🎬 Video", callback_data='download_video'),
-         InlineKeyboardButton("🎵 Audio", callback_data='download_audio')],
-        [InlineKeyboardButton("🎬+🎵 Both", callback_data='download_both')],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text('Choose download type:', reply_markup=reply_markup)
+# "Both" summary keyed by (video succeeded, audio succeeded)
+_BOTH_SUMMARIES = {
+    (True, True): "Both downloads complete! ✅",
+    (True, False): "Partial success - some downloads completed.",
+    (False, True): "Partial success - some downloads completed.",
+    (False, False): "All downloads failed. The video might be restricted.",
+}
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    choice = query.data
-    url = context.user_data.get('url')
+    # The video ID travels in the button itself, so no per-user state is kept
+    choice, _, video_id = query.data.partition(':')
+    media_type = choice.removeprefix('download_')
     chat_id = query.message.chat_id
 
-    if not url:
+    # Callback data comes from the client, so check it before it reaches
+    # yt-dlp. Buttons sent before IDs were embedded also end up here
+    if (not _BARE_VIDEO_ID_RE.fullmatch(video_id)
+            or (media_type not in MEDIA_SPECS and media_type != 'both')):
         await query.edit_message_text(text="Please send the link again.")
         return
 
+    video = video_from_id(video_id)
+
+    if media_type != 'both':
+        # A single download reports straight into the button message, whose
+        # final text ("Video sent ✅" or the error) is the completion notice
+        status = StatusMessage(context.bot, chat_id, query.message)
+        await download_and_send_media(context, chat_id, video, media_type, status)
+        return
+
     await query.edit_message_text(text="Processing your request... ⚙️")
 
-    video_success = False
-    audio_success = False
+    # Video and audio are independent downloads, so run them side by side
+    media_types = ['video', 'audio']
+    results = await asyncio.gather(
+        *(download_and_send_media(context, chat_id, video, media_type) for media_type in media_types),
+        return_exceptions=True
+    )
+    succeeded = tuple(result is True for result in results)
+    
+    # Completion message, shown in place of "Processing..."
+    await query.edit_message_text(text=_BOTH_SUMMARIES[succeeded])
+
+# --- yt-dlp helpers ---
+# Prefer formats that fit Telegram's upload limit (or whose size is unknown),
+# so the size gate only trips when nothing small enough exists
+_FITS = f'[filesize<?{MAX_FILE_SIZE}][filesize_approx<?{MAX_FILE_SIZE}]'
+
+# Everything that differs between a video and an audio download. The send
+# method takes the file under a keyword named after the media type, and the
+# returned Message exposes it under the same attribute
+MEDIA_SPECS = {
+    'video': {
+        'format': f'best[height<=480][ext=mp4]{_FITS}/best[ext=mp4]{_FITS}/best{_FITS}/best',
+        'fallback_format': 'worst[ext=mp4]/worst',
+        'emoji': '🎬',
+        'send_method': 'send_video',
+        'chat_action': ChatAction.UPLOAD_VIDEO,
+        'send_options': {'supports_streaming': True},
+    },
+    'audio': {
+        'format': f'bestaudio[ext=m4a]{_FITS}/bestaudio{_FITS}/bestaudio',
+        'fallback_format': 'worstaudio/worst',
+        'emoji': '🎵',
+        'send_method': 'send_audio',
+        'chat_action': ChatAction.UPLOAD_DOCUMENT,
+        'send_options': {},
+    },
+}
+
+class TTLCache:
+    """Small in-memory cache whose entries expire after a fixed number of seconds"""
+
+    def __init__(self, ttl: float, maxsize: int = 256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = {}
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            self._entries.pop(key, None)
+            return None
+        return value
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        return entry[1] if entry else None
 
-    if choice in ['download_video', 'download_both']:
-        video_success = await download_and_send_media(context, chat_id, url, 'video')
+    def set(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        while len(self._entries) > self.maxsize:
+            self._entries.pop(next(iter(self._entries)), None)
+
+# Cached entries are trimmed by _UNUSED_INFO_KEYS but still hold every
+# format, so keep the count modest
+_info_cache = TTLCache(INFO_CACHE_TTL, maxsize=64)
+# Telegram file_ids of finished uploads, keyed by (media_type, video ID)
+_file_id_cache = TTLCache(FILE_ID_CACHE_TTL, maxsize=1024)
+
+# Idle YoutubeDL instances per option set, reused across requests
+_ydl_pool = {}
+
+# Worker threads for blocking yt-dlp calls; the semaphore caps how many
+# downloads are in flight across all chats. Every blocking call runs under
+# the semaphore, so one thread per permitted download is enough
+_YDL_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS, thread_name_prefix='yt-dlp')
+_DOWNLOAD_SEM = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+
+# Extra attempts for an extraction answered with HTTP 429
+_RATE_LIMIT_RETRIES = 3
+
+# Mobile browser headers. Frozen like the options below, since every
+# YoutubeDL shares them (yt-dlp copies them into its own header dict)
+_HTTP_HEADERS = MappingProxyType({
+    'User-Agent': 'Mozilla/5.0 (Linux; Android 10; SM-G975F) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Mobile Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'DNT': '1',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+})
+
+# YouTube specific extractor options. Every player client costs an
+# extra API round trip; 'web' is left out because its formats need
+# the player JS that player_skip disables anyway
+_EXTRACTOR_ARGS = MappingProxyType({
+    'youtube': MappingProxyType({
+        'player_client': ['android', 'ios'],
+        'player_skip': ['configs', 'webpage', 'js'],
+        'skip': ['dash', 'hls'],
+    })
+})
+
+_FALLBACK_EXTRACTOR_ARGS = MappingProxyType({
+    'youtube': MappingProxyType({
+        'player_client': ['android'],
+        'player_skip': ['all'],
+        'skip': ['dash', 'hls'],
+    })
+})
+
+# Enhanced yt-dlp options to bypass restrictions. Built once at import;
+# get_ydl_opts() copies it and adds the per-call keys
+_BASE_YDL_OPTS = MappingProxyType({
+    'quiet': True,
     
-    if choice in ['download_audio', 'download_both']:
-        if choice == 'download_both' and not video_success:
-            await context.bot.send_message(chat_id=chat_id, text="Skipping audio since video failed.")
-        else:
-            audio_success = await download_and_send_media(context, chat_id, url, 'audio')
+    # Anti-bot bypass options
+    'no_warnings': False,
+    # Raise instead of logging and returning None, so callers can see
+    # failures and fall back
+    'ignoreerrors': False,
+    'retries': 5,
+    'fragment_retries': 5,
+    'skip_unavailable_fragments': True,
+    'extract_flat': False,
+    
+    # Request large ranged chunks, since YouTube throttles each individual
+    # stream. No fragment concurrency: both extractor-arg sets skip dash/hls,
+    # so every selectable format is a single progressive file
+    'http_chunk_size': 10 * 1024 * 1024,
+    # Start reads/writes at 64 KiB instead of 1 KiB; yt-dlp still grows the
+    # block size from there as throughput allows
+    'buffersize': 64 * 1024,
+    
+    # Bypass geographic restrictions
+    'geo_bypass': True,
+    'geo_bypass_country': 'US',
+    'geo_bypass_ip_block': None,
+    
+    # Use mobile user agents and clients
+    'http_headers': _HTTP_HEADERS,
+    
+    'extractor_args': _EXTRACTOR_ARGS,
+    
+    # Throttle to avoid detection
+    'ratelimit': 5000000,  # 5 MB/s
+    'throttled_rate': 1000000,  # 1 MB/s when throttled
     
-    # Completion message
-    if choice == 'download_video' and video_success:
-        await context.bot.send_message(chat_id=chat_id, text="Video download complete! ✅")
-    elif choice == 'download_audio' and audio_success:
-        await context.bot.send_message(chat_id=chat_id, text="Audio download complete! ✅")
-    elif choice == 'download_both':
-        if video_success and audio_success:
-            await context.bot.send_message(chat_id=chat_id, text="Both downloads complete! ✅")
-        elif video_success or audio_success:
-            await context.bot.send_message(chat_id=chat_id, text="Partial success - some downloads completed.")
+    # Alternative extractors
+    'allowed_extractors': ['youtube', 'youtube:tab'],
+    'extractor_retries': 3,
+    
+    # Force IPv4 (sometimes helps)
+    'source_address': '0.0.0.0',
+    
+    # Fail fast on stalled connections instead of hanging a worker thread
+    'socket_timeout': 15,
+    
+    # Don't write info json (reduce IO)
+    'writeinfojson': False,
+    'writethumbnail': False,
+    'writesubtitles': False,
+    'writeautomaticsub': False,
+})
+
+# Relative to the per-download directory _download() sets as 'paths'
+_OUTTMPLS = {media_type: f'%(id)s_{media_type}.%(ext)s' for media_type in MEDIA_SPECS}
+
+def get_ydl_opts(media_type: str | None = None, fallback: bool = False) -> dict:
+    """Build yt-dlp options; media_type adds the format and output template"""
+    ydl_opts = dict(_BASE_YDL_OPTS)
+
+    if fallback:
+        ydl_opts['extractor_args'] = _FALLBACK_EXTRACTOR_ARGS
+
+    if media_type:
+        spec = MEDIA_SPECS[media_type]
+        ydl_opts['format'] = spec['fallback_format' if fallback else 'format']
+        ydl_opts['outtmpl'] = _OUTTMPLS[media_type]
+
+    return ydl_opts
+
+def get_check_opts(fallback: bool = False) -> dict:
+    """Options for the metadata-only pass: never download, never expand playlists"""
+    ydl_opts = get_ydl_opts(fallback=fallback)
+    ydl_opts.update({
+        'skip_download': True,
+        'noplaylist': True,
+        'extract_flat': 'discard_in_playlist',
+    })
+    return ydl_opts
+
+@contextlib.contextmanager
+def leased_ydl(opts_factory, *args):
+    """Borrow a reusable YoutubeDL built from opts_factory(*args)"""
+    # YoutubeDL is not reentrant, so each instance serves one call at a time
+    # and goes back to the idle queue for its option set afterwards
+    idle = _ydl_pool.setdefault((opts_factory, *args), queue.SimpleQueue())
+    try:
+        ydl = idle.get_nowait()
+    except queue.Empty:
+        ydl = yt_dlp.YoutubeDL(opts_factory(*args))
+    try:
+        yield ydl
+    finally:
+        idle.put(ydl)
+
+# Metadata the bot never uses, since no subtitles or thumbnails are written.
+# The caption track URLs alone are most of a YouTube info dict
+_UNUSED_INFO_KEYS = ('automatic_captions', 'subtitles', 'thumbnails', 'heatmap')
+
+def _extract_info(url: str) -> dict:
+    """Run the extractor, retrying once with the fallback client settings"""
+    for fallback in (False, True):
+        for attempt in range(_RATE_LIMIT_RETRIES + 1):
+            try:
+                with leased_ydl(get_check_opts, fallback) as ydl:
+                    info = ydl.extract_info(url, download=False, process=False)
+                if info:
+                    info = yt_dlp.YoutubeDL.sanitize_info(info, remove_private_keys=True)
+                    for key in _UNUSED_INFO_KEYS:
+                        info.pop(key, None)
+                    return info
+                logger.warning(f"Could not extract video info (fallback={fallback})")
+            except Exception as e:
+                if 'HTTP Error 429' in str(e) and attempt < _RATE_LIMIT_RETRIES:
+                    # Back off with jitter so queued requests don't retry in lockstep
+                    delay = min(2 ** attempt, 60) + random.uniform(0, 1)
+                    logger.warning(f"YouTube rate limited extraction, retrying in {delay:.1f}s")
+                    time.sleep(delay)
+                    continue
+                logger.warning(f"Extraction attempt failed (fallback={fallback}): {e}")
+            break
+    raise Exception("Could not extract video info")
+
+async def run_blocking(func, *args):
+    """Run a blocking yt-dlp call on the worker pool so the event loop stays free"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_YDL_EXECUTOR, func, *args)
+
+async def get_info(video: dict) -> dict:
+    """Return unprocessed metadata for video, extracting it at most once per TTL"""
+    pending = _info_cache.get(video['id'])
+    if pending is None:
+        # Cache the in-flight extraction so concurrent requests share it
+        pending = asyncio.ensure_future(run_blocking(_extract_info, video['url']))
+        _info_cache.set(video['id'], pending)
+    try:
+        info = await asyncio.shield(pending)
+    except Exception:
+        _info_cache.pop(video['id'])
+        raise
+    # yt-dlp mutates the dict during format selection, so hand out copies,
+    # made off the event loop since the format list is sizeable
+    return await asyncio.to_thread(copy.deepcopy, info)
+
+def _download(ydl: yt_dlp.YoutubeDL, info: dict, media_type: str, url: str, workdir: str) -> str:
+    """Download the selected format into workdir, falling back to worst quality; returns the file path"""
+    # A leased instance serves only this call, so pointing it at this
+    # download's directory can't leak into another download
+    ydl.params['paths'] = {'home': workdir}
+    try:
+        ydl.process_info(info)
+        # process_info records the final path after post-processing
+        return info.get('filepath') or ydl.prepare_filename(info)
+    except Exception as download_error:
+        logger.warning(f"Download failed: {download_error}. Trying fallback format...")
+    
+    # Fallback to worst quality. The cached stream URLs may be what failed,
+    # so extract afresh with the fallback client instead of reusing them
+    with leased_ydl(get_ydl_opts, media_type, True) as fallback_ydl:
+        fallback_ydl.params['paths'] = {'home': workdir}
+        info = fallback_ydl.extract_info(url, download=True)
+        return info.get('filepath') or fallback_ydl.prepare_filename(info)
+
+def upload_metadata(info: dict, media_type: str) -> dict:
+    """Caption or title/performer for an upload, trimmed to the Bot API limits"""
+    # Computed once per upload; later sends of the same file reuse it from
+    # _file_id_cache. `or` also covers keys that are present but None
+    title = info.get('title')
+    if media_type == 'video':
+        return {'caption': (title or 'YouTube Video')[:1000]}
+    return {
+        'title': (title or 'YouTube Audio')[:64],
+        'performer': (info.get('uploader') or 'Uploader')[:64],
+    }
+
+async def send_media(context: ContextTypes.DEFAULT_TYPE, chat_id: int, media_type: str, media, send_kwargs: dict):
+    """Send a video or audio file (upload or Telegram file_id) to the chat"""
+    spec = MEDIA_SPECS[media_type]
+    send = getattr(context.bot, spec['send_method'])
+    return await send(chat_id=chat_id, **{media_type: media}, **spec['send_options'], **send_kwargs)
+
+async def send_cached_media(context: ContextTypes.DEFAULT_TYPE, chat_id: int, video: dict, media_type: str) -> bool:
+    """Re-send a file uploaded earlier by its file_id, skipping download and upload"""
+    cached = _file_id_cache.get((media_type, video['id']))
+    if not cached:
+        return False
+    
+    file_id, send_kwargs = cached
+    try:
+        await send_media(context, chat_id, media_type, file_id, send_kwargs)
+    except TelegramError as e:
+        logger.warning(f"Cached {media_type} file_id was rejected, downloading again: {e}")
+        _file_id_cache.pop((media_type, video['id']))
+        return False
+    return True
+
+class StatusMessage:
+    """The single progress message of a download, sent on first use and edited after"""
+
+    def __init__(self, bot, chat_id: int, message=None):
+        # An existing message (e.g. the one holding the buttons) is edited
+        # in place instead of sending a new one
+        self._bot = bot
+        self._chat_id = chat_id
+        self._message = message
+        self._text = None
+
+    @property
+    def message(self):
+        return self._message
+
+    async def set(self, text: str):
+        # Telegram rejects edits that don't change the text, and they would
+        # only spend rate-limit budget anyway
+        if text == self._text:
+            return
+        if self._message is None:
+            self._message = await self._bot.send_message(chat_id=self._chat_id, text=text)
         else:
-            await context.bot.send_message(chat_id=chat_id, text="All downloads failed. The video might be restricted.")
+            await self._bot.edit_message_text(text=text, chat_id=self._chat_id, message_id=self._message.message_id)
+        self._text = text
 
-async def download_and_send_media(context: ContextTypes.DEFAULT_TYPE, chat_id: int, url: str, media_type: str) -> bool:
+# Requests for the same file run one at a time, so later ones can re-send the
+# first upload by file_id instead of downloading it again.
+# (media_type, video ID) -> [lock, number of requests holding or awaiting it]
+_download_locks = {}
+
+@contextlib.asynccontextmanager
+async def download_lock(key: tuple):
+    entry = _download_locks.setdefault(key, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _download_locks[key]
+
+async def download_and_send_media(context: ContextTypes.DEFAULT_TYPE, chat_id: int, video: dict, media_type: str,
+                                  status: StatusMessage | None = None) -> bool:
     """Universal function for both video and audio downloads"""
-    file_path = None
-    status_msg = None
+    status = status or StatusMessage(context.bot, chat_id)
+    key = (media_type, video['id'])
+    if key in _download_locks:
+        # Someone is already fetching this file; show progress while we wait
+        await status.set(f"Downloading {media_type}... {MEDIA_SPECS[media_type]['emoji']}")
+    async with download_lock(key):
+        # A request that waited usually finds the first upload in _file_id_cache
+        return await _download_and_send_media(context, chat_id, video, media_type, status)
+
+async def _download_and_send_media(context: ContextTypes.DEFAULT_TYPE, chat_id: int, video: dict, media_type: str,
+                                   status: StatusMessage) -> bool:
+    workdir = None
+    info = None
     
     try:
-        status_msg = await context.bot.send_message(chat_id=chat_id, text=f"Preparing {media_type}...")
+        if await send_cached_media(context, chat_id, video, media_type):
+            # Don't send a status message just to say it's done, but settle
+            # one we were handed so it doesn't keep its old text
+            if status.message:
+                await status.set(f"{media_type.capitalize()} sent ✅")
+            return True
         
-        # Enhanced yt-dlp options to bypass restrictions
-        ydl_opts = {
-            'format': 'best[height<=480][ext=mp4]/best[ext=mp4]/best' if media_type == 'video' else 'bestaudio[ext=m4a]/bestaudio',
-            'outtmpl': os.path.join(DOWNLOAD_DIR, f'%(id)s_{media_type}.%(ext)s'),
-            'quiet': True,
-            
-            # Anti-bot bypass options
-            'no_warnings': False,
-            'ignoreerrors': True,
-            'retries': 5,
-            'fragment_retries': 5,
-            'skip_unavailable_fragments': True,
-            'extract_flat': False,
-            
-            # Bypass geographic restrictions
-            'geo_bypass': True,
-            'geo_bypass_country': 'US',
-            'geo_bypass_ip_block': None,
-            
-            # Use mobile user agents and clients
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Linux; Android 10; SM-G975F) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Mobile Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-                'Accept-Language': 'en-US,en;q=0.5',
-                'Accept-Encoding': 'gzip, deflate, br',
-                'DNT': '1',
-                'Connection': 'keep-alive',
-                'Upgrade-Insecure-Requests': '1',
-            },
-            
-            # YouTube specific extractor options
-            'extractor_args': {
-                'youtube': {
-                    'player_client': ['android', 'ios', 'web'],
-                    'player_skip': ['configs', 'webpage', 'js'],
-                    'skip': ['dash', 'hls'],
-                }
-            },
-            
-            # Throttle to avoid detection
-            'ratelimit': 5000000,  # 5 MB/s
-            'throttled_rate': 1000000,  # 1 MB/s when throttled
-            
-            # Alternative extractors
-            'allowed_extractors': ['youtube', 'youtube:tab'],
-            'extractor_retries': 3,
-            
-            # Force IPv4 (sometimes helps)
-            'source_address': '0.0.0.0',
-            
-            # Don't write info json (reduce IO)
-            'writeinfojson': False,
-            'writethumbnail': False,
-            'writesubtitles': False,
-            'writeautomaticsub': False,
-        }
+        # One status message per download: this text, then a final edit
+        await status.set(f"Downloading {media_type}... {MEDIA_SPECS[media_type]['emoji']}")
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            # Try to get info first
+        # Bound concurrent extractions/downloads; the upload below runs
+        # outside the limit so the next download can start meanwhile
+        async with _DOWNLOAD_SEM:
             try:
-                info = ydl.extract_info(url, download=False)
-                
-                # If we can't get info, try with different approaches
-                if not info:
-                    raise Exception("Could not extract video info")
-                    
+                info = await get_info(video)
             except Exception as e:
-                logger.warning(f"First attempt failed: {e}. Trying alternative approach...")
-                
-                # Try alternative options
-                alt_ydl_opts = ydl_opts.copy()
-                alt_ydl_opts.update({
-                    'format': 'worst[ext=mp4]/worst' if media_type == 'video' else 'worstaudio/worst',
-                    'extractor_args': {
-                        'youtube': {
-                            'player_client': ['android'],
-                            'player_skip': ['all'],
-                        }
-                    },
-                })
-                
-                try:
-                    with yt_dlp.YoutubeDL(alt_ydl_opts) as alt_ydl:
-                        info = alt_ydl.extract_info(url, download=False)
-                except Exception as alt_e:
-                    await context.bot.edit_message_text(
-                        text="❌ Cannot download this video. It might be private, age-restricted, or unavailable in this region.",
-                        chat_id=chat_id, 
-                        message_id=status_msg.message_id
-                    )
-                    logger.error(f"All download attempts failed: {alt_e}")
-                    return False
-            
-            # Check file size
-            filesize = info.get('filesize') or info.get('filesize_approx')
-            if filesize and filesize > MAX_FILE_SIZE:
-                size_mb = filesize / 1024 / 1024
-                await context.bot.edit_message_text(
-                    text=f"❌ File too large ({size_mb:.1f} MB). Max 50 MB.",
-                    chat_id=chat_id, 
-                    message_id=status_msg.message_id
-                )
+                await status.set("❌ Cannot download this video. It might be private, age-restricted, or unavailable in this region.")
+                logger.error(f"All download attempts failed: {e}")
                 return False
-
-            # Download
-            await context.bot.edit_message_text(
-                text=f"Downloading {media_type}... {'🎬' if media_type == 'video' else '🎵'}",
-                chat_id=chat_id, 
-                message_id=status_msg.message_id
-            )
             
-            try:
-                ydl.download([url])
-                file_path = ydl.prepare_filename(info)
-            except Exception as download_error:
-                logger.warning(f"Download failed: {download_error}. Trying fallback format...")
+            with leased_ydl(get_ydl_opts, media_type) as ydl:
+                # Select the format for this media type from the shared metadata
+                info = await run_blocking(ydl.process_ie_result, info, False)
                 
-                # Fallback to worst quality
-                fallback_ydl_opts = ydl_opts.copy()
-                fallback_ydl_opts['format'] = 'worst[ext=mp4]/worst' if media_type == 'video' else 'worstaudio/worst'
-                
-                with yt_dlp.YoutubeDL(fallback_ydl_opts) as fallback_ydl:
-                    fallback_ydl.download([url])
-                    file_path = fallback_ydl.prepare_filename(info)
-
-        if not os.path.exists(file_path):
-            await context.bot.edit_message_text(
-                text=f"❌ Download failed. The video format might not be supported.",
-                chat_id=chat_id, 
-                message_id=status_msg.message_id
-            )
+                # Check file size
+                filesize = info.get('filesize') or info.get('filesize_approx')
+                if filesize and filesize > MAX_FILE_SIZE:
+                    size_mb = filesize / 1024 / 1024
+                    await status.set(f"❌ File too large ({size_mb:.1f} MB). Max 50 MB.")
+                    return False
+
+                # Download, reusing the metadata extracted above instead of
+                # running the extractor a second time. Each download gets its
+                # own directory so .part leftovers go with it on cleanup
+                workdir = tempfile.mkdtemp(dir=DOWNLOAD_DIR)
+                file_path = await run_blocking(_download, ydl, info, media_type, video['url'], workdir)
+
+        # A single stat both confirms the download and gives its final size
+        try:
+            actual_size = os.stat(file_path).st_size
+        except FileNotFoundError:
+            # The cached stream URLs may have expired; extract afresh next time
+            _info_cache.pop(video['id'])
+            await status.set(f"❌ Download failed. The video format might not be supported.")
             return False
 
-        # Check final file size
-        actual_size = os.path.getsize(file_path)
         if actual_size > MAX_FILE_SIZE:
-            await context.bot.edit_message_text(
-                text=f"❌ Downloaded file too large ({actual_size/1024/1024:.1f} MB).",
-                chat_id=chat_id, 
-                message_id=status_msg.message_id
-            )
+            await status.set(f"❌ Downloaded file too large ({actual_size/1024/1024:.1f} MB).")
             return False
 
-        # Upload
-        await context.bot.edit_message_text(
-            text=f"Uploading {media_type}... 🚀",
-            chat_id=chat_id, 
-            message_id=status_msg.message_id
-        )
+        # Upload; Telegram's own "sending..." indicator replaces a status edit
+        await context.bot.send_chat_action(chat_id=chat_id, action=MEDIA_SPECS[media_type]['chat_action'])
+        
+        send_kwargs = upload_metadata(info, media_type)
+        
+        with open(file_path, 'rb') as file_handle:
+            # Hand the open handle to the HTTP backend so it is streamed in
+            # chunks instead of being read into memory on the event loop
+            media_file = InputFile(file_handle, filename=os.path.basename(file_path), read_file_handle=False)
+            message = await send_media(context, chat_id, media_type, media_file, send_kwargs)
         
-        with open(file_path, 'rb') as media_file:
-            if media_type == 'video':
-                await context.bot.send_video(
-                    chat_id=chat_id,
-                    video=media_file,
-                    supports_streaming=True,
-                    caption=info.get('title', 'YouTube Video')[:1000]
-                )
-            else:  # audio
-                await context.bot.send_audio(
-                    chat_id=chat_id,
-                    audio=media_file,
-                    title=info.get('title', 'YouTube Audio')[:64],
-                    performer=info.get('uploader', 'Uploader')[:64]
-                )
+        sent = getattr(message, media_type)
+        if sent:
+            _file_id_cache.set((media_type, video['id']), (sent.file_id, send_kwargs))
         
-        await context.bot.delete_message(chat_id=chat_id, message_id=status_msg.message_id)
+        await status.set(f"{media_type.capitalize()} sent ✅")
         return True
         
     except Exception as e:
+        if info is not None:
+            _info_cache.pop(video['id'])
         logger.error(f"Error processing {media_type}: {e}", exc_info=True)
         error_msg = f"❌ Error: {str(e)[:100]}..."
-        if status_msg:
-            await context.bot.edit_message_text(text=error_msg, chat_id=chat_id, message_id=status_msg.message_id)
-        else:
-            await context.bot.send_message(chat_id=chat_id, text=error_msg)
+        await status.set(error_msg)
         return False
         
     finally:
-        if file_path and os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except:
-                pass
+        if workdir:
+            # Removing large files can block, so keep it off the event loop
+            await asyncio.to_thread(shutil.rmtree, workdir, ignore_errors=True)
 
 def main():
     if not TELEGRAM_BOT_TOKEN:
@@ -312,12 +632,42 @@ def main():
 
     logger.info("Starting bot on Northflank...")
 
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    if uvloop:
+        uvloop.install()
+
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .rate_limiter(AIORateLimiter(max_retries=3))  # Stay under flood limits, sleep out RetryAfter
+        .http_version('2')  # Status edits share one warm connection
+        .connection_pool_size(64)
+        .pool_timeout(30)
+        .connect_timeout(10)
+        .read_timeout(60)  # Telegram can be slow to answer after a large upload
+        .media_write_timeout(600)  # Uploads of up to 50 MB
+        .get_updates_connection_pool_size(4)  # Long polls never compete with outbound calls
+        .get_updates_pool_timeout(60)
+        .build()
+    )
+
+    app.add_handlers([
+        CommandHandler("start", start_command),
+        CommandHandler("help", help_command),
+        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message),
+        CallbackQueryHandler(button_handler),
+    ])
 
-    app.add_handler(CommandHandler("start", start_command))
-    app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    app.add_handler(CallbackQueryHandler(button_handler))
+    if WEBHOOK_URL:
+        # Telegram pushes updates to us; no polling round trips at all
+        app.run_webhook(
+            listen='0.0.0.0',
+            port=PORT,
+            url_path=TELEGRAM_BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TELEGRAM_BOT_TOKEN}",
+        )
+    else:
+        # Long-poll so getUpdates waits server-side for new messages
+        app.run_polling(timeout=50, bootstrap_retries=-1)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file